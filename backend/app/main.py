@@ -1,37 +1,177 @@
+from __future__ import annotations
+
 from fastapi import FastAPI, HTTPException
 import httpx
-from bs4 import BeautifulSoup
-from typing import Optional, Dict, Any
+from typing import Optional, Union, Dict, List, Tuple, Any, Callable, Awaitable, AsyncIterator, TYPE_CHECKING
 import os
-from openai import AsyncOpenAI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from pydantic import BaseModel
 from dotenv import load_dotenv
-from playwright.async_api import async_playwright, Browser
+from cachetools import TTLCache
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+from logging.handlers import QueueHandler, QueueListener
+import asyncio
 import base64
+import copy
+import hashlib
+import logging
+import queue
+import re
 from contextlib import asynccontextmanager
 
+# Playwright, OpenAI and selectolax are imported where they are first used, which
+# keeps module import (and so worker start-up and dev reloads) fast.
+if TYPE_CHECKING:
+    from openai import AsyncOpenAI
+    from playwright.async_api import Browser, Page
+    from selectolax.lexbor import LexborHTMLParser
+
 # Load environment variables from .env file at the very start
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 # --- PERFORMANCE OPTIMIZATION START ---
 playwright_state = {}
 
+SCRAPE_CONCURRENCY = int(os.getenv("SCRAPE_CONCURRENCY", "4"))
+SCRAPE_QUEUE_MAX = int(os.getenv("SCRAPE_QUEUE_MAX", "16"))
+# Batch items share the scrape slots but may hold at most BATCH_CONCURRENCY of them, and
+# at most BATCH_QUEUE_MAX batch items may be admitted at a time across all batches.
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", str(max(1, SCRAPE_CONCURRENCY // 2))))
+BATCH_QUEUE_MAX = int(os.getenv("BATCH_QUEUE_MAX", "40"))
+PAGE_POOL_SIZE = int(os.getenv("PAGE_POOL_SIZE", str(SCRAPE_CONCURRENCY)))
+PAGE_MAX_USES = int(os.getenv("PAGE_MAX_USES", "50"))
+VIEWPORT = {"width": 1280, "height": 800}
+# Only the top of the page is captured; vision tokens scale with image tiles. The JPEG
+# is encoded by the browser, so no decode/re-encode happens in Python. Playwright trims
+# a clip to the viewport unless full_page is set, so full_page stays on with a fixed clip.
+SCREENSHOT_MAX_HEIGHT = 2048
+SCREENSHOT_QUALITY = 60
+SCREENSHOT_DETAIL = os.getenv("SCREENSHOT_DETAIL", "low")
+# Opt-in: serve pages that render without JavaScript from a plain HTTP fetch. These are
+# cloned from HTML alone, with no screenshot, so fidelity is traded for speed.
+STATIC_FAST_PATH = os.getenv("STATIC_FAST_PATH", "0") == "1"
+STATIC_MIN_TEXT_CHARS = 200
+SPA_ROOT_IDS = ("root", "app", "__next", "__nuxt")
+
+async def new_pooled_page(browser: Browser) -> Page:
+    """Open a page in its own isolated browser context with the scraping defaults."""
+    context = await browser.new_context(viewport=VIEWPORT, java_script_enabled=True)
+    page = await context.new_page()
+    playwright_state["page_uses"][page] = 0
+    return page
+
+async def acquire_page() -> Optional[Page]:
+    """
+    Take a page from the pool. Slots whose page was discarded hold None and are
+    refilled here, so a broken page is only replaced when it is next needed.
+    """
+    pages: asyncio.Queue = playwright_state["pages"]
+    page = await pages.get()
+    if page is not None:
+        return page
+    try:
+        return await new_pooled_page(playwright_state["browser"])
+    except Exception as e:
+        logger.warning("Failed to open a replacement page: %s", e)
+        pages.put_nowait(None)
+        return None
+
+async def release_page(page: Page):
+    """
+    Reset a page to about:blank and return it to the pool. Pages that fail the reset,
+    or have served PAGE_MAX_USES scrapes, are closed along with their context so
+    cookies, cache and memory don't accumulate indefinitely.
+    """
+    uses = playwright_state["page_uses"].pop(page, 0) + 1
+    if uses < PAGE_MAX_USES and not page.is_closed():
+        try:
+            await page.goto("about:blank")
+            await page.context.clear_cookies()
+            playwright_state["page_uses"][page] = uses
+            playwright_state["pages"].put_nowait(page)
+            return
+        except Exception as e:
+            logger.warning("Discarding page that failed to reset: %s", e)
+    try:
+        await page.context.close()
+    except Exception as e:
+        logger.warning("Failed to close recycled page: %s", e)
+    playwright_state["pages"].put_nowait(None)
+
+class RawQueueHandler(QueueHandler):
+    """QueueHandler that enqueues records unformatted, leaving formatting to the listener."""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return copy.copy(record)
+
+def start_log_listener() -> QueueListener:
+    """
+    Route this module's log records through a queue so formatting and the stdout write
+    happen on a background thread instead of blocking the event loop.
+    """
+    log_queue = queue.SimpleQueue()
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    listener = QueueListener(log_queue, stream_handler)
+    logger.handlers = [RawQueueHandler(log_queue)]
+    logger.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+    logger.propagate = False
+    listener.start()
+    return listener
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """
-    Context manager to launch a persistent Playwright browser instance on app startup
-    and gracefully close it on shutdown.
+    Context manager to launch a persistent Playwright browser instance on app startup,
+    pre-warm a pool of pages, create the shared HTTP and OpenAI clients, and gracefully
+    close everything on shutdown.
     """
+    from openai import AsyncOpenAI
+    from playwright.async_api import async_playwright
+
+    log_listener = start_log_listener()
+    api_key = os.getenv("OPENAI_API_KEY")
+    if api_key:
+        playwright_state["openai"] = AsyncOpenAI(
+            api_key=api_key,
+            max_retries=2,
+            # A 10k-token non-streaming completion can take minutes; only the connect is short.
+            timeout=LLM_TIMEOUT,
+            http_client=httpx.AsyncClient(
+                http2=True,
+                limits=httpx.Limits(max_keepalive_connections=32, max_connections=64),
+            ),
+        )
+    playwright_state["http"] = httpx.AsyncClient(http2=True, follow_redirects=True, timeout=10)
+    playwright_state["sem"] = asyncio.Semaphore(SCRAPE_CONCURRENCY)
+    playwright_state["pending_scrapes"] = 0
+    playwright_state["batch_sem"] = asyncio.Semaphore(BATCH_CONCURRENCY)
+    playwright_state["pending_batch_items"] = 0
     async with async_playwright() as p:
-        print("Launching persistent browser instance...")
-        browser = await p.chromium.launch(headless=True)
+        logger.info("Launching persistent browser instance...")
+        # Autoplay media is the bulk of what a screenshot doesn't need; stopping it in the
+        # browser keeps the HTTP cache and costs no per-request round-trip to Python.
+        browser = await p.chromium.launch(headless=True, args=["--autoplay-policy=user-gesture-required"])
         playwright_state["browser"] = browser
+        playwright_state["page_uses"] = {}
+        pages = asyncio.Queue()
+        for _ in range(PAGE_POOL_SIZE):
+            pages.put_nowait(await new_pooled_page(browser))
+        playwright_state["pages"] = pages
         yield
-        print("Closing persistent browser instance...")
+        logger.info("Closing persistent browser instance...")
+        for page in list(playwright_state["page_uses"]):
+            await page.context.close()
         await browser.close()
+    await playwright_state.pop("http").aclose()
+    if "openai" in playwright_state:
+        await playwright_state.pop("openai").close()
+    log_listener.stop()
 
-app = FastAPI(lifespan=lifespan)
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 # --- PERFORMANCE OPTIMIZATION END ---
 
 # Configure CORS for frontend
@@ -46,66 +186,304 @@ app.add_middleware(
 def read_root():
     return {"message": "Hello World"}
 
-async def scrape_website(url: str) -> Optional[Dict[str, Any]]:
+async def scrape_website(url: str, fail_fast: bool = True) -> Optional[Dict[str, Any]]:
     """
     Asynchronously scrape a website using the PERSISTENT Playwright browser instance
-    to get both the HTML content and a screenshot.
+    to get both the HTML content and a screenshot. At most SCRAPE_CONCURRENCY scrapes
+    run at once; beyond SCRAPE_QUEUE_MAX waiting requests, new ones fail fast with 429.
+    With fail_fast=False (batch items, already admitted by clone_batch_endpoint) the
+    scrape waits for a slot instead, holding at most BATCH_CONCURRENCY of them.
     """
-    browser: Browser = playwright_state.get("browser")
-    if not browser:
-        print("Browser not available!")
+    async with scrape_slot(fail_fast):
+        if STATIC_FAST_PATH:
+            html_content = await fetch_static(url)
+            if html_content is not None:
+                logger.info("Fetched %s without the browser", url)
+                return {
+                    "html": html_content,
+                    "screenshot_url": None
+                }
+
+        if "pages" not in playwright_state:
+            logger.error("Browser not available!")
+            return None
+        captured = await scrape_with_pooled_page(url)
+    if captured is None:
         return None
 
-    page = await browser.new_page()
+    # Trim and encode off the event loop, after the browser slot has already been handed back.
+    html_content, screenshot_bytes = captured
+    del captured
+    html_content, screenshot_url = await asyncio.gather(
+        asyncio.to_thread(trim_html, html_content),
+        asyncio.to_thread(screenshot_data_url, screenshot_bytes),
+    )
+    del screenshot_bytes
+    return {
+        "html": html_content,
+        "screenshot_url": screenshot_url
+    }
+
+@asynccontextmanager
+async def scrape_slot(fail_fast: bool = True) -> AsyncIterator[None]:
+    """Hold one of the SCRAPE_CONCURRENCY scrape slots, see scrape_website."""
+    if not fail_fast:
+        async with playwright_state["batch_sem"], playwright_state["sem"]:
+            yield
+        return
+
+    if playwright_state["pending_scrapes"] >= SCRAPE_CONCURRENCY + SCRAPE_QUEUE_MAX:
+        raise HTTPException(status_code=429, detail="Too many clone requests in progress. Try again shortly.")
+    playwright_state["pending_scrapes"] += 1
     try:
-        print(f"Scraping {url} with Playwright...")
-        await page.goto(url, wait_until="networkidle", timeout=30000)
-        
-        html_content = await page.content()
-        soup = BeautifulSoup(html_content, "html.parser")
-        
-        screenshot_bytes = await page.screenshot(full_page=True)
-        screenshot_base64 = base64.b64encode(screenshot_bytes).decode('utf-8')
-        
-        print("Scraping successful.")
-        return {
-            "html": soup.prettify(),
-            "screenshot": screenshot_base64
-        }
-    except Exception as e:
-        print(f"Scraping failed with Playwright: {e}")
-        return None
+        async with playwright_state["sem"]:
+            yield
     finally:
-        if not page.is_closed():
-            await page.close()
+        playwright_state["pending_scrapes"] -= 1
 
-async def clone_with_llm(data: Dict[str, Any]) -> Optional[str]:
-    """Use an OpenAI multimodal model to generate a static page from HTML and a screenshot."""
+async def fetch_static(url: str) -> Optional[str]:
+    """
+    Fetch a page with plain HTTP and return its trimmed HTML. Returns None when the
+    request fails or the page looks like it needs JavaScript to render, so the caller
+    falls back to Playwright.
+    """
     try:
-        api_key = os.getenv("OPENAI_API_KEY")
-        if not api_key:
-            raise RuntimeError("OPENAI_API_KEY not set")
-        
-        client = AsyncOpenAI(api_key=api_key)
-        
-        html_content = data["html"]
-        screenshot_base64 = data.get("screenshot")
-
-        # --- UPDATED PROMPT TO DEMAND HIGH FIDELITY ---
-        system_prompt = (
-            "You are an automated frontend assistant. Your task is to generate a single, static HTML file that is a HIGH-FIDELITY visual reproduction of a provided screenshot. "
-            "A low-fidelity or simplified version is considered a failure. "
-            "This is for a design-to-code exercise. Do not replicate the page's functionality, only its static visual design. "
-            "The screenshot is the source of truth for all visual styles. The provided HTML is only a structural guide. "
-            "RULES: "
-            "1. The entire output must be a single, self-contained HTML file. "
-            "2. All CSS must be in a single `<style>` tag in the `<head>`. "
-            "3. ALL `<img>` tags MUST use this exact placeholder: `<img src='https://placehold.co/600x400/EEE/31343C?text=Image'>`. "
-            "4. Do NOT include any `<script>` tags or JavaScript. "
-            "5. Your response MUST contain ONLY the raw HTML code. Do not add any '```', comments, or explanations."
+        response = await playwright_state["http"].get(url)
+    except httpx.HTTPError as e:
+        logger.info("Static fetch failed for %s: %s", url, e)
+        return None
+    if response.status_code != 200 or "text/html" not in response.headers.get("content-type", ""):
+        return None
+    return await asyncio.to_thread(static_page_html, response.text)
+
+def static_page_html(html: str) -> Optional[str]:
+    """Parse once, and trim the page unless needs_javascript rejects it."""
+    from selectolax.lexbor import LexborHTMLParser
+
+    tree = LexborHTMLParser(html)
+    if needs_javascript(tree):
+        return None
+    return trim_tree(tree)
+
+def needs_javascript(tree: LexborHTMLParser) -> bool:
+    """
+    Heuristic: an empty SPA mount point, a JS-required <noscript>, or almost no body text.
+    Cleans the tree as a side effect.
+    """
+    if tree.body is None:
+        return True
+    for root_id in SPA_ROOT_IDS:
+        root = tree.body.css_first(f"#{root_id}")
+        if root is not None and not root.text(strip=True):
+            return True
+    for noscript in tree.body.css("noscript"):
+        if "enable javascript" in noscript.text(separator=" ", strip=True).lower():
+            return True
+    clean_tree(tree)
+    return len(tree.body.text(separator=" ", strip=True)) < STATIC_MIN_TEXT_CHARS
+
+def screenshot_data_url(screenshot_bytes: bytes) -> str:
+    """Build the JPEG data URL in one bytes join and a single ASCII decode."""
+    return (b"data:image/jpeg;base64," + base64.b64encode(screenshot_bytes)).decode('ascii')
+
+async def wait_until_rendered(page: Page):
+    """
+    Bounded readiness checks after DOMContentLoaded: wait briefly for the load event,
+    then for SPAs to put something in <body>. Timeouts are not errors; we capture
+    whatever has rendered by then rather than waiting out beacons and long-polls.
+    """
+    from playwright.async_api import TimeoutError as PlaywrightTimeoutError
+
+    try:
+        await page.wait_for_load_state("load", timeout=4000)
+    except PlaywrightTimeoutError:
+        pass
+    try:
+        await page.wait_for_function(
+            "document.readyState === 'complete' && document.body && document.body.children.length > 0",
+            timeout=3000,
         )
+    except PlaywrightTimeoutError:
+        pass
+
+async def scrape_with_pooled_page(url: str) -> Optional[Tuple[str, bytes]]:
+    """Borrow a page from the pool, capture the target URL, and hand the page back."""
+    page = await acquire_page()
+    if page is None:
+        return None
+    try:
+        logger.info("Scraping %s with Playwright", url)
+        await page.goto(url, wait_until="domcontentloaded", timeout=15000)
+        await wait_until_rendered(page)
         
-        # --- RESTRUCTURED USER MESSAGE TO FOCUS AI ON THE IMAGE ---
+        html_content, screenshot_bytes = await asyncio.gather(
+            page.content(),
+            page.screenshot(
+                full_page=True,
+                type="jpeg",
+                quality=SCREENSHOT_QUALITY,
+                clip={"x": 0, "y": 0, "width": VIEWPORT["width"], "height": SCREENSHOT_MAX_HEIGHT},
+            ),
+        )
+        return html_content, screenshot_bytes
+    except Exception as e:
+        logger.warning("Scraping failed with Playwright: %s", e)
+        return None
+    finally:
+        await release_page(page)
+
+# --- HTML TRIMMING ---
+# ~10k tokens. The screenshot carries the visual detail; the HTML only needs its structure.
+HTML_MAX_CHARS = int(os.getenv("HTML_MAX_CHARS", "40000"))
+STRIPPED_TAGS = ["script", "style", "noscript", "svg", "template", "iframe"]
+# What survives of <head> once the document has to be cut down: the model only needs these.
+HEAD_KEPT_SELECTORS = ["title", "meta[charset]", "meta[name=viewport]"]
+HEAD_MAX_CHARS = 1000
+# Landmarks kept, in priority order, when the cleaned document is still over budget. Page
+# chrome goes first: it is small and easily crowded out by a long <main>.
+LANDMARK_PRIORITY = [["header", "nav", "footer"], ["main", "article"], ["section"]]
+# Below this much remaining budget, an oversized landmark is skipped rather than truncated.
+MIN_TRUNCATED_CHARS = 1000
+_WHITESPACE_RE = re.compile(r"\s+")
+
+def compact(markup: str) -> str:
+    return _WHITESPACE_RE.sub(" ", markup).strip()
+
+def clean_tree(tree: LexborHTMLParser) -> None:
+    """Remove markup the model can't use: scripts, styles, inline SVG, data URIs, comments."""
+    tree.strip_tags(STRIPPED_TAGS)
+    for node in tree.css('[src^="data:"]'):
+        node.decompose()
+    comments = [node for node in tree.root.traverse(include_text=False) if node.tag == "-comment"]
+    for node in comments:
+        node.decompose()
+
+def trim_tree(tree: LexborHTMLParser, max_chars: int = HTML_MAX_CHARS) -> str:
+    """
+    Serialize a cleaned tree with whitespace collapsed. If that is over max_chars, keep a
+    minimal <head> plus the highest-priority landmarks that fit, in document order. Once
+    every group has been placed, the best landmark that did not fit is truncated into
+    whatever budget is left.
+    """
+    trimmed = compact(tree.html or "")
+    if len(trimmed) <= max_chars or tree.body is None:
+        return trimmed[:max_chars]
+
+    head = "".join(compact(node.html) for selector in HEAD_KEPT_SELECTORS for node in tree.css(selector))
+    head = f"<head>{head[:HEAD_MAX_CHARS]}</head>"
+    budget = max_chars - len(head) - len("<html><body></body></html>")
+    kept = {}  # mem_id -> markup
+    # Ancestors of kept elements; keeping one of these would duplicate content.
+    contains_kept_ids = set()
+    # Landmarks too large for the budget at the time they were reached, best first.
+    oversized = []
+    for names in LANDMARK_PRIORITY:
+        # Oversized elements in this group; their nested matches are skipped rather than
+        # serialized one by one.
+        rejected_ids = set()
+        for node in tree.body.css(",".join(names)):
+            ancestor_ids = set()
+            parent = node.parent
+            while parent is not None:
+                ancestor_ids.add(parent.mem_id)
+                parent = parent.parent
+            if node.mem_id in contains_kept_ids or not ancestor_ids.isdisjoint(kept) or not ancestor_ids.isdisjoint(rejected_ids):
+                continue
+            markup = compact(node.html)
+            if len(markup) > budget:
+                rejected_ids.add(node.mem_id)
+                oversized.append((node, markup, ancestor_ids))
+                continue
+            kept[node.mem_id] = markup
+            contains_kept_ids |= ancestor_ids
+            budget -= len(markup)
+
+    # Only now spend what is left on a cut-down copy of the best landmark that didn't fit.
+    for node, markup, ancestor_ids in oversized:
+        if budget < MIN_TRUNCATED_CHARS:
+            break
+        if node.mem_id in contains_kept_ids or not ancestor_ids.isdisjoint(kept):
+            continue
+        kept[node.mem_id] = markup[:budget]
+        budget = 0
+
+    if not kept:
+        body = compact(tree.body.html)[:max(budget, 0)]
+    else:
+        # Put the kept landmarks back in document order.
+        body = "".join(kept[node.mem_id] for node in tree.body.traverse(include_text=False) if node.mem_id in kept)
+    return f"<html>{head}<body>{body}</body></html>"
+
+def trim_html(html: str, max_chars: int = HTML_MAX_CHARS) -> str:
+    """Clean and trim raw page HTML down to max_chars for the prompt."""
+    from selectolax.lexbor import LexborHTMLParser
+
+    tree = LexborHTMLParser(html)
+    clean_tree(tree)
+    return trim_tree(tree, max_chars)
+
+LLM_MODEL = "gpt-4.1-2025-04-14"
+CONTENT_FILTERED_MESSAGE = "The request was blocked by the content filter."
+LLM_MAX_TOKENS = 10000
+LLM_TIMEOUT = httpx.Timeout(float(os.getenv("LLM_TIMEOUT", "600")), connect=10)
+# Sent as the `user` field so requests from this service share an OpenAI prompt-cache route.
+LLM_CACHE_USER = os.getenv("LLM_CACHE_USER", "website-cloner")
+
+# --- UPDATED PROMPT TO DEMAND HIGH FIDELITY ---
+# OpenAI caches identical prompt prefixes longer than 1024 tokens. This prompt and the
+# fixed opening text of the user message are kept byte-for-byte stable and above that
+# size; everything that varies per page (screenshot, HTML) goes at the end.
+SYSTEM_PROMPT = (
+    "You are an automated frontend assistant. Your task is to generate a single, static HTML file that is a HIGH-FIDELITY visual reproduction of a provided screenshot. "
+    "A low-fidelity or simplified version is considered a failure. "
+    "This is for a design-to-code exercise. Do not replicate the page's functionality, only its static visual design. "
+    "The screenshot is the source of truth for all visual styles. The provided HTML is only a structural guide. "
+    "RULES: "
+    "1. The entire output must be a single, self-contained HTML file. "
+    "2. All CSS must be in a single `<style>` tag in the `<head>`. "
+    "3. ALL `<img>` tags MUST use this exact placeholder: `<img src='https://placehold.co/600x400/EEE/31343C?text=Image'>`. "
+    "4. Do NOT include any `<script>` tags or JavaScript. "
+    "5. Your response MUST contain ONLY the raw HTML code. Do not add any '```', comments, or explanations.\n\n"
+    "STYLE GUIDE:\n"
+    "Document structure. Start with `<!DOCTYPE html>`, then `<html lang=\"en\">`, a `<head>` containing `<meta charset=\"utf-8\">`, "
+    "`<meta name=\"viewport\" content=\"width=device-width, initial-scale=1\">`, a `<title>` taken from the page, and the single `<style>` block. "
+    "Use semantic landmarks that mirror the page: `<header>`, `<nav>`, `<main>`, `<section>`, `<article>`, `<aside>` and `<footer>`. "
+    "Keep the order of regions exactly as it appears in the screenshot, from top to bottom.\n"
+    "Layout. Reproduce the page at a 1280px-wide desktop viewport. Use flexbox for one-dimensional rows and columns and CSS grid for card grids and multi-column layouts. "
+    "Match the content width, outer margins, gutters between columns, and vertical spacing between sections as closely as you can measure them from the screenshot. "
+    "Centered content usually sits in a container with a max-width and auto horizontal margins; reproduce that container rather than hard-coding left offsets. "
+    "Do not use absolute positioning except for elements that visibly overlap, such as badges or text over a hero image.\n"
+    "Color. Sample colors from the screenshot and write them as hex values. Define the palette once as CSS custom properties on `:root` "
+    "(for example `--color-bg`, `--color-text`, `--color-muted`, `--color-accent`, `--color-border`) and reference them throughout. "
+    "Reproduce gradients, overlays and section background colors; a plain white page where the screenshot shows colored bands is a failure.\n"
+    "Typography. Pick a system font stack that best matches the typeface in the screenshot: a sans-serif stack such as "
+    "`-apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, Helvetica, Arial, sans-serif`, a serif stack such as `Georgia, 'Times New Roman', serif`, "
+    "or a monospace stack such as `ui-monospace, SFMono-Regular, Menlo, Consolas, monospace`. Do not load web fonts. "
+    "Match the relative sizes of headings, body text, captions and buttons, their font weights, letter spacing, line height, and text transform such as uppercase labels.\n"
+    "Text content. Copy visible text verbatim from the screenshot, including headings, navigation labels, button labels and footer links. "
+    "Where text is too small to read, use the corresponding text from the provided HTML. Never invent marketing copy and never use lorem ipsum when real text is available.\n"
+    "Components. Style buttons, links, inputs, cards, badges and navigation items to match their borders, border radius, padding, shadows and hover-free resting state. "
+    "Links must use `href=\"#\"`. Forms are visual only: render inputs and buttons but omit `action` attributes. "
+    "Icons should be approximated with simple inline shapes built from CSS or Unicode characters; do not reference external icon fonts or sprite sheets.\n"
+    "Images. Every image, logo, illustration, avatar and background photo becomes the placeholder `<img>` from rule 3, sized with CSS to the dimensions it occupies in the screenshot, "
+    "using `width`, `height` or `aspect-ratio` together with `object-fit: cover`. Keep the `alt` text from the original HTML when it exists.\n"
+    "CSS quality. Use a short reset at the top of the stylesheet (`*, *::before, *::after { box-sizing: border-box; }` and zeroed body margin). "
+    "Prefer class selectors with descriptive, lowercase, hyphenated names. Avoid inline `style` attributes, `!important`, and vendor-specific hacks. "
+    "Do not reference any external stylesheet, font, script or asset other than the image placeholder.\n"
+    "Completeness. Reproduce every region visible in the screenshot, including the header, hero, all content sections, and the footer if it is visible. "
+    "Do not stop early, summarize repeated items, or leave sections as empty placeholders; if the screenshot shows six cards, output six cards.\n"
+    "Final check. Before answering, compare your page against the screenshot region by region: the same sections in the same order, the same number of columns and items, "
+    "matching background colors, matching heading sizes, and matching alignment of text and buttons. Fix any mismatch before you respond. "
+    "Then make sure the response begins with `<!DOCTYPE html>`, ends with `</html>`, and contains nothing else."
+)
+
+def build_messages(data: Dict[str, Any]) -> list:
+    """Assemble the system and user messages sent to the model for a scraped page."""
+    html_content = data["html"]
+    screenshot_url = data["screenshot_url"]
+
+    # --- RESTRUCTURED USER MESSAGE TO FOCUS AI ON THE IMAGE ---
+    if screenshot_url:
         user_content = [
             {
                 "type": "text",
@@ -114,61 +492,413 @@ async def clone_with_llm(data: Dict[str, Any]) -> Optional[str]:
             {
                 "type": "image_url",
                 "image_url": {
-                    "url": f"data:image/png;base64,{screenshot_base64}",
-                    "detail": "high"
+                    "url": screenshot_url,
+                    "detail": SCREENSHOT_DETAIL
                 },
             },
+        ]
+    else:
+        # Static fast path: there is no screenshot, so the HTML has to stand in for it.
+        user_content = [
             {
                 "type": "text",
-                "text": f"Here is the original HTML for structural reference:\n\n{html_content}"
-            }
+                "text": "No screenshot is available for this page. Your task is to create a high-fidelity static HTML recreation of the visual design implied by the provided HTML, including its layout, typography, and colors."
+            },
         ]
+    user_content.append(
+        {
+            "type": "text",
+            "text": f"Here is the original HTML for structural reference:\n\n{html_content}"
+        }
+    )
 
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": user_content}
+    ]
+
+# Opening fence (with any language tag), closing fence, and CRs from CRLF line endings.
+_FENCE_RE = re.compile(r"\A\s*```[\w-]*[ \t]*\n?|\s*```\s*\Z|\r(?=\n)")
+
+def strip_fences(text: str) -> str:
+    """Remove Markdown code fences around the model output and normalize newlines in one pass."""
+    return _FENCE_RE.sub("", text).strip()
+
+async def clone_with_llm(data: Dict[str, Any]) -> Optional[str]:
+    """Use an OpenAI multimodal model to generate a static page from HTML and a screenshot."""
+    try:
+        client: AsyncOpenAI = playwright_state.get("openai")
+        if client is None:
+            raise RuntimeError("OPENAI_API_KEY not set")
 
         response = await client.chat.completions.create(
-            model="gpt-4.1-2025-04-14",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_content}
-            ],
-            max_tokens=10000,
+            model=LLM_MODEL,
+            messages=build_messages(data),
+            max_tokens=LLM_MAX_TOKENS,
+            user=LLM_CACHE_USER,
         )
         
         if response.choices and response.choices[0].message.content:
-            generated_html = response.choices[0].message.content.strip()
-            if generated_html.startswith("```html"):
-                generated_html = generated_html[7:]
-            if generated_html.endswith("```"):
-                generated_html = generated_html[:-3]
-            return generated_html.strip()
+            return strip_fences(response.choices[0].message.content)
         else:
             reason = response.choices[0].finish_reason if response.choices else "No choices returned"
-            print(f"!!! AI response was empty or invalid. Finish Reason: {reason}")
+            logger.warning("AI response was empty or invalid. Finish Reason: %s", reason)
             if reason == 'content_filter':
-                return "The request was blocked by the content filter."
+                return CONTENT_FILTERED_MESSAGE
             return None
 
     except Exception as e:
-        print(f"An error occurred in clone_with_llm: {e}")
+        logger.exception("An error occurred in clone_with_llm: %s", e)
         return None
 
+# Pieces of _FENCE_RE applied incrementally by FenceStripper.
+_OPENING_FENCE_RE = re.compile(r"```[\w-]*[ \t]*")
+_CLOSING_FENCE_RE = re.compile(r"\s*```\s*\Z")
+# Trailing whitespace and backticks that could still grow into a closing fence.
+_PENDING_TAIL_RE = re.compile(r"\s*`{0,3}\s*\Z")
+
+class FenceStripper:
+    """
+    Incrementally applies strip_fences() to streamed model output. Trailing whitespace
+    and up to three backticks are held back until more text arrives or the stream ends,
+    since they may turn out to be the closing fence.
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        self.fence_checked = False
+        self.at_start = True
+
+    def feed(self, text: str) -> str:
+        self.buffer += text
+        if self.at_start and not self._consume_opening_fence(final=False):
+            return ""
+        hold = _PENDING_TAIL_RE.search(self.buffer).start()
+        out, self.buffer = self.buffer[:hold], self.buffer[hold:]
+        # `out` never ends in whitespace, so a CRLF pair is never split across calls.
+        return out.replace("\r\n", "\n")
+
+    def finish(self) -> str:
+        if self.at_start:
+            self._consume_opening_fence(final=True)
+        tail = _CLOSING_FENCE_RE.sub("", self.buffer)
+        self.buffer = ""
+        return tail.replace("\r\n", "\n").rstrip()
+
+    def _consume_opening_fence(self, final: bool) -> bool:
+        """Strip the opening fence and leading whitespace; False while still ambiguous."""
+        stripped = self.buffer.lstrip()
+        if not self.fence_checked:
+            if stripped.startswith("```"):
+                match = _OPENING_FENCE_RE.match(stripped)
+                if match.end() == len(stripped) and not final:
+                    return False
+                stripped = stripped[match.end():].lstrip()
+            elif not final and "```".startswith(stripped):
+                return False
+            self.fence_checked = True
+        self.buffer = stripped
+        if not stripped and not final:
+            return False
+        self.at_start = False
+        return True
+
+async def stream_with_llm(data: Dict[str, Any]) -> Union[AsyncIterator[str], str, None]:
+    """
+    Start a streaming completion and return an iterator over the generated HTML.
+    The stream is read up to its first piece of output before returning, so failures
+    surface like clone_with_llm's: None if the request failed or produced nothing, and
+    CONTENT_FILTERED_MESSAGE if it was blocked by the content filter.
+    """
+    try:
+        client: AsyncOpenAI = playwright_state.get("openai")
+        if client is None:
+            raise RuntimeError("OPENAI_API_KEY not set")
+
+        stream = await client.chat.completions.create(
+            model=LLM_MODEL,
+            messages=build_messages(data),
+            max_tokens=LLM_MAX_TOKENS,
+            user=LLM_CACHE_USER,
+            stream=True,
+        )
+    except Exception as e:
+        logger.exception("An error occurred in stream_with_llm: %s", e)
+        return None
+
+    finish_reasons = []
+
+    async def generate() -> AsyncIterator[str]:
+        fence = FenceStripper()
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+            choice = chunk.choices[0]
+            if choice.finish_reason:
+                finish_reasons.append(choice.finish_reason)
+            if choice.delta and choice.delta.content:
+                text = fence.feed(choice.delta.content)
+                if text:
+                    yield text
+        text = fence.finish()
+        if text:
+            yield text
+
+    texts = generate()
+    try:
+        first = await anext(texts, None)
+    except Exception as e:
+        logger.exception("An error occurred in stream_with_llm: %s", e)
+        first = None
+        finish_reasons.append("error")
+    if first is None:
+        await texts.aclose()
+        await stream.close()
+        reason = finish_reasons[-1] if finish_reasons else "No choices returned"
+        logger.warning("AI response was empty or invalid. Finish Reason: %s", reason)
+        if reason == "content_filter":
+            return CONTENT_FILTERED_MESSAGE
+        return None
+
+    async def relay() -> AsyncIterator[str]:
+        try:
+            yield first
+            async for text in texts:
+                yield text
+        finally:
+            # Release the upstream response even if the client disconnects mid-stream.
+            await texts.aclose()
+            await stream.close()
+
+    return relay()
+
+# --- CACHING ---
+# Scrapes go stale quickly; generated HTML is keyed on the exact page content, so it can live longer.
+scrape_cache = TTLCache(maxsize=256, ttl=int(os.getenv("SCRAPE_CACHE_TTL", "300")))
+llm_cache = TTLCache(maxsize=256, ttl=int(os.getenv("LLM_CACHE_TTL", "86400")))
+in_flight: Dict[str, asyncio.Task] = {}
+
+def normalize_url(url: str) -> str:
+    """Lower-case scheme and host, sort query parameters, and drop the fragment."""
+    parts = urlsplit(url.strip())
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path or "/", query, ""))
+
+def page_fingerprint(data: Dict[str, Any]) -> str:
+    """Content hash of a scrape, used as the key for the generated-HTML cache."""
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(data["html"].encode())
+    digest.update((data["screenshot_url"] or "").encode("ascii"))
+    return digest.hexdigest()
+
+def start_shared(key: str, compute: Callable[[], Awaitable[Any]]) -> asyncio.Task:
+    """
+    Return the task computing key, starting compute() in a new one if none is in flight.
+    The task belongs to no single request, so a caller going away never cancels it for
+    the others.
+    """
+    task = in_flight.get(key)
+    if task is None:
+        task = in_flight[key] = asyncio.ensure_future(compute())
+
+        def finished(task: asyncio.Task) -> None:
+            in_flight.pop(key, None)
+            if not task.cancelled():
+                task.exception()  # mark retrieved in case every caller has gone away
+
+        task.add_done_callback(finished)
+    return task
+
+def storing(cache: TTLCache, key: str, compute: Callable[[], Awaitable[Any]]) -> Callable[[], Awaitable[Any]]:
+    """Wrap compute so that a successful (not None) result is also stored as cache[key]."""
+    async def compute_and_store() -> Any:
+        result = await compute()
+        if result is not None:
+            cache[key] = result
+        return result
+    return compute_and_store
+
+async def cached(cache: TTLCache, key: str, compute: Callable[[], Awaitable[Any]]) -> Any:
+    """
+    Return cache[key], computing it at most once even under concurrent requests:
+    callers arriving while a computation is in flight await the same result.
+    Failed computations (None or an exception) are not cached.
+    """
+    if key in cache:
+        return cache[key]
+    return await asyncio.shield(start_shared(key, storing(cache, key, compute)))
+
+class StreamingGeneration:
+    """
+    One streaming completion shared by every /api/clone/stream request for the same page.
+    The model call runs in a start_shared task, so /api/clone callers for the page await
+    it like any other in-flight generation. Each streaming caller replays the text
+    produced so far and then follows it live.
+    """
+    def __init__(self, key: str, data: Dict[str, Any]):
+        self.parts: List[str] = []
+        self.changed = asyncio.Event()
+        self.task = start_shared(key, storing(llm_cache, key, lambda: self.run(data)))
+        self.task.add_done_callback(lambda _: self.wake())
+
+    async def run(self, data: Dict[str, Any]) -> Optional[str]:
+        """Same result as clone_with_llm, collecting the text as it arrives."""
+        chunks = await stream_with_llm(data)
+        if chunks is None or isinstance(chunks, str):
+            return chunks
+        try:
+            async for text in chunks:
+                self.parts.append(text)
+                self.wake()
+        finally:
+            await chunks.aclose()
+        return "".join(self.parts)
+
+    def wake(self) -> None:
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    async def follow(self) -> AsyncIterator[str]:
+        """Yield every part in order, raising at the end if the model call failed."""
+        index = 0
+        while True:
+            while index < len(self.parts):
+                yield self.parts[index]
+                index += 1
+            if self.task.done():
+                self.task.result()
+                return
+            await self.changed.wait()
+
+streaming_generations: Dict[str, StreamingGeneration] = {}
+
+def shared_generation(key: str, data: Dict[str, Any]) -> Optional[StreamingGeneration]:
+    """
+    Return the streaming generation in flight for key, starting one if nothing is. Returns
+    None when a non-streaming generation for key is already in flight.
+    """
+    generation = streaming_generations.get(key)
+    if generation is None and key not in in_flight:
+        generation = streaming_generations[key] = StreamingGeneration(key, data)
+        generation.task.add_done_callback(lambda _: streaming_generations.pop(key, None))
+    return generation
+
 class CloneRequest(BaseModel):
     url: str
 
-@app.post("/api/clone")
-async def clone_website_endpoint(request: CloneRequest):
-    scraped_data = await scrape_website(request.url)
+class BatchCloneRequest(BaseModel):
+    urls: List[str]
+
+BATCH_MAX_URLS = 20
+
+async def scrape_one(url: str, fail_fast: bool = True) -> Dict[str, Any]:
+    """Cached scrape of one URL, raising HTTPException on failure."""
+    scraped_data = await cached(
+        scrape_cache, f"scrape:{normalize_url(url)}", lambda: scrape_website(url, fail_fast)
+    )
     if scraped_data is None:
         raise HTTPException(status_code=500, detail="Failed to scrape the target website.")
-        
-    generated_html = await clone_with_llm(scraped_data)
+    return scraped_data
+
+def checked_generation(generated_html: Optional[str]) -> str:
+    """Map a failed or content-filtered generation to the matching HTTPException."""
     if generated_html is None:
         raise HTTPException(status_code=500, detail="AI model failed to generate the HTML content.")
-    if "The request was blocked by the content filter." in generated_html:
+    if CONTENT_FILTERED_MESSAGE in generated_html:
         raise HTTPException(status_code=400, detail="AI content filter blocked the request. Try a different URL.")
-        
+    return generated_html
+
+async def clone_one(url: str, fail_fast: bool = True) -> str:
+    """Run the cached scrape + LLM pipeline for one URL, raising HTTPException on failure."""
+    scraped_data = await scrape_one(url, fail_fast)
+    generated_html = await cached(
+        llm_cache, f"llm:{page_fingerprint(scraped_data)}", lambda: clone_with_llm(scraped_data)
+    )
+    return checked_generation(generated_html)
+
+@app.post("/api/clone")
+async def clone_website_endpoint(request: CloneRequest):
+    generated_html = await clone_one(request.url)
     return {"html_content": generated_html}
 
+@app.post("/api/clone_batch")
+async def clone_batch_endpoint(request: BatchCloneRequest):
+    """
+    Clone several URLs in parallel, each URL reporting its own result so one failure
+    doesn't abort the batch. A batch is admitted whole or rejected with 429 when it would
+    take the number of admitted batch items past BATCH_QUEUE_MAX. Admitted items wait for
+    a scrape slot but hold at most BATCH_CONCURRENCY of them, leaving the rest to single
+    /api/clone requests.
+    """
+    if len(request.urls) > BATCH_MAX_URLS:
+        raise HTTPException(status_code=413, detail=f"A batch may contain at most {BATCH_MAX_URLS} URLs.")
+    if playwright_state["pending_batch_items"] + len(request.urls) > BATCH_QUEUE_MAX:
+        raise HTTPException(status_code=429, detail="Too many batch clones in progress. Try again shortly.")
+
+    playwright_state["pending_batch_items"] += len(request.urls)
+    try:
+        results = await asyncio.gather(
+            *[clone_one(url, fail_fast=False) for url in request.urls], return_exceptions=True
+        )
+    finally:
+        playwright_state["pending_batch_items"] -= len(request.urls)
+
+    response = []
+    for url, result in zip(request.urls, results):
+        if isinstance(result, HTTPException):
+            response.append({"url": url, "html_content": None, "error": result.detail})
+        elif isinstance(result, BaseException):
+            logger.error("Batch clone failed for %s: %r", url, result)
+            response.append({"url": url, "html_content": None, "error": "Unexpected error while cloning."})
+        else:
+            response.append({"url": url, "html_content": result, "error": None})
+    return response
+
+@app.post("/api/clone/stream")
+async def clone_website_stream_endpoint(request: CloneRequest):
+    """
+    Same pipeline as /api/clone, but the generated HTML is streamed back as text/html
+    while the model produces it. Concurrent requests for the same page share one model
+    call, and a client disconnecting doesn't stop it for the others.
+    """
+    scraped_data = await scrape_one(request.url)
+    llm_key = f"llm:{page_fingerprint(scraped_data)}"
+    generation = None if llm_key in llm_cache else shared_generation(llm_key, scraped_data)
+    if generation is None:
+        # Already generated, or an /api/clone call for this page is generating it now.
+        generated_html = await cached(llm_cache, llm_key, lambda: clone_with_llm(scraped_data))
+        return StreamingResponse(iter([checked_generation(generated_html)]), media_type="text/html")
+
+    # Wait for the first part so failures still map to an HTTP status.
+    parts = generation.follow()
+    try:
+        first = await anext(parts, None)
+    except Exception as e:
+        logger.error("Streaming generation failed for %s: %r", request.url, e)
+        first = None
+    if first is None:
+        await parts.aclose()
+        result = None if generation.task.cancelled() or generation.task.exception() else generation.task.result()
+        return StreamingResponse(iter([checked_generation(result)]), media_type="text/html")
+
+    async def relay() -> AsyncIterator[str]:
+        try:
+            yield first
+            async for text in parts:
+                yield text
+        finally:
+            await parts.aclose()
+
+    return StreamingResponse(relay(), media_type="text/html")
+
 if __name__ == "__main__":
+    # Run as `python -m app.main` so the import string below resolves in each worker.
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    uvicorn.run(
+        "app.main:app",
+        host="0.0.0.0",
+        port=8000,
+        loop="uvloop",
+        http="httptools",
+        workers=int(os.getenv("WORKERS", "2")),
+    )
\ No newline at end of file